@@ -1,45 +1,100 @@
 #!/usr/bin/env python3
 
-from time import sleep
+import asyncio
+from collections import deque
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3Error
+from json import JSONDecodeError
 import subprocess
 import logging
 import argparse
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+else:
+    # Only stream with the C backend, the pure-Python ones are slower than decoding the whole body with orjson
+    if ijson.backend != "yajl2_c":
+        ijson = None
+
 _LOGGER = logging.getLogger(__name__)
 
-def truncate_utf8(s, max_bytes=200):
+# Errors from requesting or reading and decoding the feed. Streaming reads from the raw urllib3 response
+_FETCH_ERRORS = (requests.RequestException, Urllib3Error, JSONDecodeError)
+if ijson is not None:
+    _FETCH_ERRORS += (ijson.JSONError,)
+
+_get_id = itemgetter("id")
+
+# Alert message, filled from the fields fetch_alerts keeps for each warning area
+_MSG_TMPL = "SMHI: {lvl} varning för {area} - {desc} från {start} till {end}"
+
+# Reuse one keep-alive connection to the SMHI API between polls
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+# Validators and result of the last successful fetch, used for conditional requests
+_last_etag = None
+_last_modified = None
+_last_result = (set(), {})
+
+@lru_cache(maxsize=256)
+def truncate_utf8(s: str, max_bytes: int = 200, *, max_messages: int = 2) -> tuple[str, ...]:
+
+    # Pure ASCII strings have one byte per character, so len() is the byte length
+    is_ascii = s.isascii()
+    if is_ascii:
+        n_bytes = len(s)
+    else:
+        encoded = s.encode('utf-8')
+        n_bytes = len(encoded)
 
     # If our string is already shorter than 200 bytes, do nothing 
-    if len(s.encode('utf-8')) <= max_bytes: 
-        return [s]
+    if n_bytes <= max_bytes: 
+        return (s,)
 
     # Worst case suffix length
-    suffix_length = len(f" {MAX_MESSAGES}/{MAX_MESSAGES}".encode('utf-8')) 
-    extra_suffix_length = 0
+    suffix_length = len(f" {max_messages}/{max_messages}".encode('utf-8')) 
+
+    # Byte budget per chunk. The last allowed chunk also needs room for " [...]"
+    budget_normal = max_bytes - suffix_length
+    budget_last = budget_normal - 6
+    budget = budget_last if max_messages == 1 else budget_normal
 
     words = s.split(" ")
     chunks = []
     current_words = []
     current_size = 0  # track byte length in UTF-8
 
-    for word in words:
-        word_bytes = word.encode('utf-8')
-        word_size = len(word_bytes)
+    # Byte length of every word, measured up front in one pass.
+    # Space is a single byte in UTF-8, so splitting the encoded string yields the same words.
+    if is_ascii:
+        word_sizes = [len(word) for word in words]
+    else:
+        word_sizes = [len(word_bytes) for word_bytes in encoded.split(b" ")]
+
+    for word, word_size in zip(words, word_sizes):
 
         # If the word alone is bigger than max_bytes, skip it. This is extremely unlikely.
         if word_size > max_bytes:
             continue
         extra = 1 + word_size
 
-        if len(chunks) == MAX_MESSAGES-1:
-            extra_suffix_length = 6
-
         # If we add " " + word, measure extra bytes
         # (space is 1 byte in UTF-8, plus the new word's bytes)
 
-        if current_size + extra <= max_bytes-suffix_length-extra_suffix_length:
+        if current_size + extra <= budget:
             # Fits in current chunk
             current_words.append(word)
             current_size += extra
@@ -48,7 +103,7 @@ def truncate_utf8(s, max_bytes=200):
             chunks.append(" ".join(current_words))
 
 
-            if len(chunks) == MAX_MESSAGES:
+            if len(chunks) == max_messages:
                 chunks[-1] += " [...]"
                 # Start a new chunk with the current word
                 current_words = []
@@ -56,6 +111,9 @@ def truncate_utf8(s, max_bytes=200):
 
                 break
 
+            if len(chunks) == max_messages-1:
+                budget = budget_last
+
             # Start a new chunk with the current word
             current_words = [word]
             current_size = word_size
@@ -64,65 +122,125 @@ def truncate_utf8(s, max_bytes=200):
     if current_words:
         chunks.append(" ".join(current_words))
 
-    for i in range(len(chunks)):
-        chunks[i] = chunks[i].strip() + f" {i+1}/{len(chunks)}"
+    n = len(chunks)
+    # Return a tuple since results are shared through the cache
+    return tuple(f"{chunk.strip()} {i}/{n}" for i, chunk in enumerate(chunks, 1))
 
-    return chunks
-
-def fetch_alerts():
+def parse_alerts(response, geocode):
     """
-    Fetch alerts from the SMHI API.
+    Parse the alerts in a response, keeping the warning areas that affect geocode.
     """
-    _LOGGER.debug("Fetching %s", API_URL)
-    try:
-        response = requests.get(API_URL, timeout=10)
-        response.raise_for_status()  # Raise an HTTPError if the response was unsuccessful
-    except requests.RequestException as e:
-        _LOGGER.error("Error fetching alerts: ", e)
-        return set()
-
-    data = response.json()
+    if ijson is not None:
+        # Parse alerts one at a time straight off the socket. Each alert is still built whole, 'area' included,
+        # but only one is held at a time instead of the whole body plus the whole decoded feed
+        response.raw.decode_content = True
+        data = ijson.items(response.raw, "item")
+    else:
+        data = json_loads(response.content)
     
     alert_ids = set()
-    filtered_alerts = []
+    alerts_by_id = {}
     
     for alert in data:
         alert_id = alert["id"]
         for wa in alert["warningAreas"]:
-            
-            # Filter out MESSAGEs
-            if wa["warningLevel"]["code"] == "MESSAGE":
-                continue
+            try:
+                # Filter out MESSAGEs
+                if wa["warningLevel"]["code"] == "MESSAGE":
+                    continue
+
+                # Check if warningArea affects area with id=geocode
+                if geocode in map(_get_id, wa["affectedAreas"]):
+                    # Build the concatenated string "alertIDwarningAreaID"
+                    combined_id = f"{alert_id}{wa['id']}"
+
+                    # Copy only the fields we use, leaving out the 'area' object since it is useless and very large
+                    wa_copy = {
+                        'id': combined_id,
+                        'lvl': wa['warningLevel']['sv'],
+                        'area': wa['areaName']['sv'],
+                        'desc': wa['eventDescription']['sv'],
+                        'start': datetime.fromisoformat(wa['approximateStart']).strftime('%Y-%m-%d %H:%M'),
+                        'end': datetime.fromisoformat(wa['approximateEnd']).strftime('%Y-%m-%d %H:%M'),
+                    }
+                    alert_ids.add(combined_id)
+                    alerts_by_id[combined_id] = wa_copy
+            except (KeyError, TypeError, ValueError) as e:
+                # One malformed warning area must not take down the whole fetch
+                _LOGGER.error("Skipping malformed warning area in alert %s: %r", alert_id, e)
+
+    return alert_ids, alerts_by_id
+
+
+def fetch_alerts(url, geocode):
+    """
+    Fetch alerts from the SMHI API.
+    Returns None if the fetch failed.
+    Sends the validators of the last response, so an unchanged feed is answered with 304 and not parsed again.
+    The feed is stream-parsed with ijson when its C backend is available.
+    """
+    global _last_etag, _last_modified, _last_result
+
+    headers = {}
+    if _last_etag:
+        headers["If-None-Match"] = _last_etag
+    if _last_modified:
+        headers["If-Modified-Since"] = _last_modified
+
+    _LOGGER.debug("Fetching %s", url)
+    try:
+        with SESSION.get(url, headers=headers, timeout=10, stream=True) as response:
+            response.raise_for_status()  # Raise an HTTPError if the response was unsuccessful
+
+            if response.status_code == 304:
+                _LOGGER.debug("Alerts not modified since last fetch")
+                return _last_result
 
-            # Check if warningArea affects area with id=GEOCODE
-            if any(a["id"] == GEOCODE for a in wa["affectedAreas"]) :
-                # Build the concatenated string "alertIDwarningAreaID"
-                combined_id = f"{alert_id}{wa['id']}"
+            # The body is read while parsing, so a dropped connection or read timeout can surface here too
+            result = parse_alerts(response, geocode)
+    except _FETCH_ERRORS as e:
+        _LOGGER.error("Error fetching alerts: %s", e)
+        return None
 
-                # Make a shallow copy of the warningArea dict without the 'area' key
-                wa_copy = dict(wa)
-                wa_copy.pop("area", None)  # remove the area object if present since it is useless and very large
-                wa_copy['id'] = combined_id
-                alert_ids.add(combined_id)
-                filtered_alerts.append(wa_copy)
+    _last_etag = response.headers.get("ETag")
+    _last_modified = response.headers.get("Last-Modified")
+    _last_result = result
 
-    return alert_ids, filtered_alerts
+    return _last_result
 
 
-def call_meshtastic(template, message, output=True):
+def open_interface(connection_type, connection_argument):
+    """
+    Open a persistent connection to the radio through the meshtastic Python library
+    """
+    if connection_type == "host":
+        from meshtastic.tcp_interface import TCPInterface
+        return TCPInterface(hostname=connection_argument)
+    if connection_type == "port":
+        from meshtastic.serial_interface import SerialInterface
+        return SerialInterface(devPath=connection_argument)
+    if connection_type == "ble":
+        from meshtastic.ble_interface import BLEInterface
+        return BLEInterface(address=connection_argument)
+    raise ValueError(f"Unknown connection type: {connection_type}")
+
+
+async def call_meshtastic(template, message, output=True):
     """
     Call meshtastic to send message
     """
-    meshtastic_cmd = template.copy()
-    meshtastic_cmd.append(message)
+    meshtastic_cmd = (*template, message)
 
     try:
-        if not DRY_RUN:
-            result = subprocess.run(meshtastic_cmd, capture_output = True, text = True, check = True)
-            stdout = result.stdout
-        else:
+        if DRY_RUN:
             stdout = "DRY RUN: "+message
-            
+        else:
+            proc = await asyncio.create_subprocess_exec(*meshtastic_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            out, err = await proc.communicate()
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, meshtastic_cmd, out, err)
+            stdout = out.decode()
+
         if output:
             _LOGGER.info(stdout.strip())
         return stdout
@@ -131,7 +249,57 @@ def call_meshtastic(template, message, output=True):
         return False
 
 
-def main():
+def reconnect_interface():
+    """
+    Replace a failed meshtastic connection with a newly opened one
+    """
+    global INTERFACE
+    try:
+        INTERFACE.close()
+    except Exception as e:
+        _LOGGER.debug("Error closing meshtastic connection: %s", e)
+    INTERFACE = open_interface(CONNECTION_TYPE, CONNECTION_ARGUMENT)
+    _LOGGER.info("Reconnected to meshtastic device")
+
+
+def send_interface(messages):
+    """
+    Send messages over the persistent meshtastic connection
+    """
+    for message in messages:
+        try:
+            INTERFACE.sendText(message, channelIndex=int(CHANNEL))
+        except Exception as e:
+            # The library raises OSError, MeshInterfaceError or BLE errors depending on the link
+            _LOGGER.error("Error sending message over meshtastic connection: %s", e)
+            try:
+                # The link is likely gone, reopen it and retry once
+                reconnect_interface()
+                INTERFACE.sendText(message, channelIndex=int(CHANNEL))
+            except Exception as e:
+                # If reopening failed, the next send tries again
+                _LOGGER.error("Could not send message after reconnecting: %s", e)
+                continue
+        _LOGGER.info("Sent: %s", message)
+
+
+async def send_messages(messages):
+    """
+    Send messages one at a time, in order
+    """
+    if not messages:
+        return
+
+    if INTERFACE is not None:
+        # Hand the whole batch to one worker thread, all sent over the same open connection
+        await asyncio.to_thread(send_interface, messages)
+        return
+
+    for message in messages:
+        await call_meshtastic(MESHTASTIC_CMD_TEMPLATE, message)
+
+
+async def main():
     """
     Main loop:
     1. Fetches alerts
@@ -143,43 +311,51 @@ def main():
     first = not DRY_RUN
 
     # This is how we handle message queueing.
-    # This list contains new lists, each of which will contain messages. Every iteration, first list is .pop() and a new on appended. 
-    message_queue = [[] for i in range(REPEAT_NUM_CYCL*REPEAT_NUM_MSG)]
+    # This deque contains lists, each of which will contain messages. Every iteration, first list is .popleft() and a new one appended. 
+    message_queue = deque([[] for i in range(REPEAT_NUM_CYCL*REPEAT_NUM_MSG)])
     known_alerts = set()  # Keep track of the alerts we have seen
 
     while True:
+        queued_messages = []
         if REPEAT_NUM_MSG > 0 and REPEAT_NUM_CYCL > 0:
-            # Start by sending any queued messages
-            queued_messages = message_queue.pop(0)
+            # Start by picking up any queued messages
+            queued_messages = message_queue.popleft()
 
             _LOGGER.debug(f"QUEUE: {len(queued_messages)} messages to be sent this iteration")
-            
-            for message in queued_messages:
-                call_meshtastic(MESHTASTIC_CMD_TEMPLATE, message)
 
             message_queue.append([]) # Create new empty queue slot
 
-        # Fetch new alerts
-        current_alerts, data = fetch_alerts()
+        # Send queued messages while fetching new alerts
+        _, result = await asyncio.gather(
+            send_messages(queued_messages),
+            asyncio.to_thread(fetch_alerts, API_URL, GEOCODE),
+        )
+
+        if result is None:
+            # Fetch failed. Leave known_alerts and 'first' untouched so active alerts are not re-broadcast once it recovers
+            _LOGGER.debug("Sleeping for %s seconds...", INTERVAL)
+            await asyncio.sleep(INTERVAL)
+            continue
+
+        current_alerts, data = result
 
         # Find what's new compared to known_alerts
-        new_alerts = current_alerts - known_alerts
+        new_alerts = current_alerts.difference(known_alerts)
 
         _LOGGER.info("Got %s alerts in total of which %s were new.", len(current_alerts), len(new_alerts))
 
         if not first: # Make sure we don't spam the channel when script starts. Assume any alerts that are already present have been sent already
 
             for id in new_alerts:
-                alert = next((d for d in data if d["id"] == id), None)
+                alert = data[id]
 
-                message = f"SMHI: {alert['warningLevel']['sv']} varning för {alert['areaName']['sv']} - {alert['eventDescription']['sv']} från {datetime.fromisoformat(alert['approximateStart']).strftime('%Y-%m-%d %H:%M')} till {datetime.fromisoformat(alert['approximateEnd']).strftime('%Y-%m-%d %H:%M')}"
+                message = _MSG_TMPL.format_map(alert)
                 print(message)
     
-                new_messages = truncate_utf8(message)
+                new_messages = truncate_utf8(message, max_messages=MAX_MESSAGES)
                 _LOGGER.debug(f"Alert was split into {len(new_messages)} messages. Sending now")
 
-                for message in new_messages:
-                    call_meshtastic(MESHTASTIC_CMD_TEMPLATE, message)
+                await send_messages(new_messages)
                 
                 if REPEAT_NUM_MSG > 0 and REPEAT_NUM_CYCL > 0:
                     # Add new messages to queue
@@ -188,8 +364,9 @@ def main():
                         _LOGGER.debug(f"QUEUE: Added {len(new_messages)} messages to queue slot {(i+1)*REPEAT_NUM_CYCL}.")
 
 
-        # Update our known alerts set
-        known_alerts = current_alerts
+        # Update our known alerts set: forget expired alerts, then add the new ones
+        known_alerts &= current_alerts
+        known_alerts |= new_alerts
         if first:
             _LOGGER.debug("Variable 'first' = False")
             first = False
@@ -197,19 +374,20 @@ def main():
 
         # Sleep for INTERVAL seconds before checking again
         _LOGGER.debug("Sleeping for %s seconds...", INTERVAL)
-        sleep(INTERVAL)
+        await asyncio.sleep(INTERVAL)
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Fetches Swedish weather warnings from SMHI and broadcasts them to your local Meshtastic network.")
 
-    # Required:
-    parser.add_argument("executable", type=str, help="Path to meshtastic executable")
+    # Required unless --python-api is given:
+    parser.add_argument("executable", type=str, nargs="?", help="Path to meshtastic executable. Not needed with --python-api")
 
     # Optional
     parser.add_argument("--verbose", action="store_true", help="Increase output verbosity. [False]")
     parser.add_argument("--dry-run", action="store_true", help="Suspend calls to meshtastic executable [False]")
+    parser.add_argument("--python-api", action="store_true", help="Keep one connection open through the meshtastic Python library instead of running the executable for every message [False]")
     parser.add_argument("--connection-type", type=str, default="host", help="Connection type (host/port/ble) [host]")
     parser.add_argument("--connection-argument", type=str, default="localhost", help="Connection argument [localhost]")
     parser.add_argument("--ch-index", type=str, default="0", help="Meshtastic channel to which messages will be sent. [0]")
@@ -221,6 +399,9 @@ if __name__ == "__main__":
     parser.add_argument("--repeat-cycles", type=int, default=2, help="Number of api-intervals between rebroadcast. [2]")
     args = parser.parse_args()
 
+    if args.executable is None and not args.python_api:
+        parser.error("the following arguments are required: executable (unless --python-api is given)")
+
     if args.verbose:
         logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.DEBUG)
     else:
@@ -235,13 +416,17 @@ if __name__ == "__main__":
     REPEAT_NUM_MSG = args.repeat_number
     REPEAT_NUM_CYCL = args.repeat_cycles
 
-    MESHTASTIC_CMD_TEMPLATE = [args.executable, "--"+args.connection_type, args.connection_argument, "--ch-index", CHANNEL, "--sendtext"]  # Message will be appended at the end
+    MESHTASTIC_CMD_TEMPLATE = (args.executable, "--"+args.connection_type, args.connection_argument, "--ch-index", CHANNEL, "--sendtext")  # Message will be appended at the end
+    CONNECTION_TYPE = args.connection_type
+    CONNECTION_ARGUMENT = args.connection_argument
+    INTERFACE = None
 
     _LOGGER.info(f"""Starting meshtastic_VMA\n
 Parameters:
     verbose: {args.verbose}
     dry-run: {DRY_RUN}
     executable: {args.executable}
+    python-api: {args.python_api}
     connection-type: {args.connection_type}
     connection-argument: {args.connection_argument}
     ch-index: {CHANNEL}
@@ -253,10 +438,16 @@ Parameters:
     repeat-cycles: {REPEAT_NUM_CYCL}
 
     Constructed API_URL: {API_URL}
-    Constructed MESHTASTIC_CMD_TEMPLATE: {" ".join(MESHTASTIC_CMD_TEMPLATE)} [message]""")
+    Constructed MESHTASTIC_CMD_TEMPLATE: {" ".join(map(str, MESHTASTIC_CMD_TEMPLATE))} [message]""")
 
     # Attempt connecting to radio
-    if not DRY_RUN and not call_meshtastic([args.executable], "--info", False):
+    if not DRY_RUN and args.python_api:
+        INTERFACE = open_interface(CONNECTION_TYPE, CONNECTION_ARGUMENT)
+    elif not DRY_RUN and not asyncio.run(call_meshtastic([args.executable], "--info", False)):
         raise Exception("Could not communicate with meshtastic device") 
     
-    main()
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    finally:
+        if INTERFACE is not None:
+            INTERFACE.close()
\ No newline at end of file